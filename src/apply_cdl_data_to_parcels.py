@@ -1,14 +1,18 @@
 from concurrent.futures import Future, ProcessPoolExecutor, as_completed
-import json
 import math
+import multiprocessing
 from multiprocessing import cpu_count
+import operator
 import os
 import time
 from typing import Any, Generator
 
-import fiona
 import geopandas
+import orjson
 import pandas
+import pyarrow
+import pyarrow.csv
+import pyogrio
 import rich
 from alive_progress import alive_bar, alive_it
 
@@ -17,7 +21,8 @@ from clip_cropscape_to_area_of_interest import \
     clip_cropscape_to_area_of_interest
 from multiprocess_counter import multiprocess_counter
 from reclassify_raster import PixelRemapSpecs, reclassify_rasters
-from summarize_raster import summarize_raster
+from summarize_raster import (compute_feature_windows, read_feature_layer,
+                              summarize_raster)
 
 
 def apply_cdl_data_to_parcels(
@@ -26,7 +31,7 @@ def apply_cdl_data_to_parcels(
   clipped_rasters_folder: str,
   consolidated_rasters_folder: str,
   reclass_spec: PixelRemapSpecs,
-  parcels_shp_path: str,
+  parcels_source: str | tuple[str, str],
   id_key: str,
   clipped_parcels_rasters_folder: str,
   parcels_summary_file: str,
@@ -46,7 +51,7 @@ def apply_cdl_data_to_parcels(
     clipped_rasters_folder (str): Path to the folder where clipped rasters will be saved.
     consolidated_rasters_folder (str): Path to the folder where consolidated rasters will be saved.
     reclass_spec (PixelRemapSpecs): The pixel remap specifications for consolidating cropland classes.
-    parcels_shp_path (str): Path to the shapefile containing parcel data.
+    parcels_source (str | tuple[str, str]): Path to the file containing parcel data, or a (geopackage path, layer name) tuple for multi-layer sources.
     id_key (str): The column name with a unique identifier for each parcel.
     clipped_parcels_rasters_folder (str): Path to the folder where clipped parcel rasters will be saved.
     parcels_summary_file (str): Path to the file where the summary data will be saved.
@@ -76,10 +81,21 @@ def apply_cdl_data_to_parcels(
     reclassify_rasters(clipped_rasters_folder, consolidated_rasters_folder, reclass_spec)
     # console.log('Cropland classess consolidated')
 
+  # read the parcels layer once and reuse the frame in the summary join, the
+  # trajectories loop, and the trajectories join below
+  # (each read decodes every geometry, which takes minutes on large chunks)
+  status.update('Reading parcels layer...')
+  (parcels_path, parcels_layer) = parcels_source if isinstance(parcels_source, tuple) else (parcels_source, None)
+  parcels_name = parcels_layer if parcels_layer else os.path.splitext(os.path.basename(parcels_path))[0]
+  parcels_gdf = read_feature_layer(parcels_path, id_key, layer=parcels_layer)
+
   if not skip_summary_data:
     # create a list containing the paths to all consilidated rasters
     # so we can easily loop through them later
-    consolidated_rasters_list = sorted([(f'{consolidated_rasters_folder}/{str}', int(str[0:4])) for str in os.listdir(consolidated_rasters_folder) if str.endswith("_30m_cdls.tif")], key=lambda x: x[1])
+    # (os.scandir avoids an extra stat call per entry, which adds up on network filesystems)
+    with os.scandir(consolidated_rasters_folder) as entries:
+      consolidated_rasters_list = [(entry.path, int(entry.name[0:4])) for entry in entries if entry.name.endswith('_30m_cdls.tif')]
+    consolidated_rasters_list.sort(key=operator.itemgetter(1))
 
     # generate summary data for each cropland data year and parcel
     # and store it in the `summary_data` list
@@ -89,7 +105,8 @@ def apply_cdl_data_to_parcels(
     summary_data =  list(
                       generate_summary_data(
                         reordered_consolidated_rasters_list,
-                        parcels_shp_path,
+                        parcels_name,
+                        parcels_gdf,
                         clipped_parcels_rasters_folder,
                         id_key,
                         status=status,
@@ -104,31 +121,46 @@ def apply_cdl_data_to_parcels(
     parcels_summary_file_root = os.path.splitext(parcels_summary_file)[0]
     if (not os.path.isdir(summary_data_folder_path)): 
       os.makedirs(summary_data_folder_path)
-    with open(f'{parcels_summary_file_root}.json', "w") as file:
+    # (orjson encodes in native code, several times faster than the stdlib
+    # encoder for this shape of nested data; OPT_NON_STR_KEYS covers the
+    # integer pixel class keys that json.dump silently stringified)
+    with open(f'{parcels_summary_file_root}.json', "wb") as file:
       with alive_bar(title='Saving summary data JSON', monitor=False):
-        json.dump(summary_data, file, indent=2) 
+        file.write(orjson.dumps(summary_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
 
     # create tidy data from the summary data
-    tidy = []
+    # (each year's breakdown is flattened into an Arrow table right away so the
+    # data is held in columnar form instead of one Python dict per parcel-year,
+    # and the reflective pandas.json_normalize pass is skipped entirely)
+    tidy_tables = []
     for entry in alive_it(summary_data, title="Creating tidy data"):
       year = entry['cropland_year']
-      breakdowns = entry['data']['breakdown']
-      breakdowns_with_year = [{'cropland_year': year, **breakdown} for breakdown in breakdowns]
-      tidy += breakdowns_with_year
+      rows = [
+        {
+          'cropland_year': year,
+          'id': breakdown['id'],
+          'total_pixels': breakdown['total_pixels'],
+          **{f'pixel_counts.{pixel_class}': count for pixel_class, count in breakdown['pixel_counts'].items()},
+        }
+        for breakdown in entry['data']['breakdown']
+      ]
+      tidy_tables.append(pyarrow.Table.from_pylist(rows))
     with alive_bar(title='Creating data frame', monitor=False):
-      tidy_df = pandas.json_normalize(tidy)
+      tidy_df = pyarrow.concat_tables(tidy_tables, promote_options='default').to_pandas()
       # ensure id is a string
       tidy_df['id'] = tidy_df['id'].astype(str)
       # console.log(f'Summary data saved to {parcels_summary_file_root}.json')
     
     # save the `summary_data` list to tidy CSV file
+    # (pyarrow's CSV writer serializes the flat columns directly instead of
+    # going through pandas' row-by-row text encoding)
     with alive_bar(title='Saving tidy data CSV', monitor=False):
-      tidy_df.to_csv(f'{parcels_summary_file_root}.csv', index=False)
+      pyarrow.csv.write_csv(pyarrow.Table.from_pandas(tidy_df, preserve_index=False), f'{parcels_summary_file_root}.csv')
       # console.log(f'Tidy summary data saved to {parcels_summary_file_root}.csv')
       
-    # join summary data to parcels shapefile
+    # join summary data to parcels features
     merged_with_summaries_gdf = join_pixel_counts_to_featurs(
-      parcels_shp_path=parcels_shp_path,
+      parcels_gdf=parcels_gdf,
       tidy_df=tidy_df,
       reclass_spec=reclass_spec,
       id_key=id_key
@@ -136,7 +168,9 @@ def apply_cdl_data_to_parcels(
     
     # save the merged data to a geopackage
     with alive_bar(title=f'Saving parcels with CDL counts to geopackage {parcels_gpkg_output_path}', monitor=False):
-      merged_with_summaries_gdf.to_file(parcels_gpkg_output_path, layer='Parcels with CDL counts', driver='GPKG', append=True)
+      # pyogrio wraps the bulk insert in a single SQLite transaction instead of
+      # committing per feature, and builds the spatial index once at the end
+      pyogrio.write_dataframe(merged_with_summaries_gdf, parcels_gpkg_output_path, layer='Parcels with CDL counts', driver='GPKG', append=True)
     
     print(f'Elapsed time: {time.time() - start_time} seconds ({(time.time() - start_time) / 60} minutes)')
 
@@ -144,33 +178,32 @@ def apply_cdl_data_to_parcels(
   if not skip_trajectories:
     trajectories = []
     # console.log(f'Generating trajectories for each feature within {parcels_shp_path}...')
-    parcels_gdf = geopandas.read_file(parcels_shp_path, engine='pyogrio', use_arrow=True)
     with alive_bar(len(parcels_gdf), title='Generating trajectories (slow)') as bar:
-      
-      with ProcessPoolExecutor(math.floor((cpu_count() - 1) / 2)) as executor:
-        futures: list[tuple[Any, Future[dict[str, int]]]] = []
-              
-        for index, feature in parcels_gdf.iterrows():
-          id_value = feature[id_key]
-          parcelnumb = feature['parcelnumb']
-          future = executor.submit(
-                      calculate_pixel_trajectories,
-                      f'{clipped_parcels_rasters_folder}/{parcelnumb}',
-                      reclass_spec,
-                      None, # f'{clipped_parcels_rasters_folder}/{feature["properties"]["parcelnumb"]}/trajectories.json',
-                      f'./working/temp/trajectories/{parcelnumb}',
-                      # status=status
-                    )
-          futures.append((id_value, future))
-          
-        for future in as_completed([future for (id_value, future) in futures]):
-          bar()
-          
-        for (id_value, future) in futures:
-          trajectories.append({
-            id_key: id_value,
-            'CDL_trajectories': future.result()
-          })
+
+      workers = math.floor((cpu_count() - 1) / 2)
+      with ProcessPoolExecutor(workers) as executor:
+        # submit batches of parcels instead of one task per parcel so that the
+        # process dispatch and pickling overhead is amortized across each batch
+        # (with hundreds of thousands of parcels, per-parcel submissions spend
+        # more time on IPC than on the actual pixel math)
+        parcel_ids = list(zip(parcels_gdf[id_key].tolist(), parcels_gdf['parcelnumb'].tolist()))
+        batch_size = max(math.ceil(len(parcel_ids) / max(workers * 8, 1)), 1)
+        batches = [parcel_ids[pos:pos + batch_size] for pos in range(0, len(parcel_ids), batch_size)]
+
+        futures: list[Future[list[tuple[Any, dict[str, int]]]]] = []
+        for batch in batches:
+          futures.append(executor.submit(_calculate_pixel_trajectories_batch, batch, reclass_spec, clipped_parcels_rasters_folder))
+
+        for future in as_completed(futures):
+          bar(len(future.result()))
+
+        # collect the results in the order they were submitted
+        for future in futures:
+          for (id_value, result) in future.result():
+            trajectories.append({
+              id_key: id_value,
+              'CDL_trajectories': result
+            })
 
     # console.log('Saving pixel trajectories data for features in {parcels_shp_path}...')  
     
@@ -179,68 +212,112 @@ def apply_cdl_data_to_parcels(
     parcels_trajectories_file_root = os.path.splitext(parcels_trajectories_file)[0]
     if (not os.path.isdir(trajectories_data_folder_path)): 
       os.makedirs(trajectories_data_folder_path)
-    with open(f'{parcels_trajectories_file_root}.json', "w") as file:
+    with open(f'{parcels_trajectories_file_root}.json', "wb") as file:
       with alive_bar(title='Saving trajectories data JSON', monitor=False):
-        json.dump(trajectories, file, indent=2) 
+        file.write(orjson.dumps(trajectories, option=orjson.OPT_INDENT_2))
         # console.log(f'Pixel trajectories saved to {parcels_summary_file_root}.json')
     
     # save the `tidy_trajectories` list to tidy CSV file
     with alive_bar(title='Saving trajectories data CSV', monitor=False):
       trajectories_df = pandas.DataFrame(trajectories)
       # convert the id to a string with length 13
-      trajectories_df[id_key] = trajectories_df[id_key].apply('{:0>13}'.format)
+      # (str.zfill runs as a single vectorized pass instead of calling the
+      # format machinery once per row)
+      trajectories_df[id_key] = trajectories_df[id_key].astype(str).str.zfill(13)
       trajectories_df.to_csv(f'{parcels_trajectories_file_root}.csv', index=False)
       # console.log(f'Tidy pixel trajectories data saved to {parcels_summary_file_root}.csv')
         
-    # join trajectory data to parcels shapefile
+    # join trajectory data to parcels features
     merged_with_trajectories_gdf = join_pixel_trajectories_to_features(
-      parcels_shp_path=parcels_shp_path,
+      parcels_gdf=parcels_gdf,
       trajectories_df=trajectories_df,
       id_key=id_key
     )
     
     # save the merged data to a geopackage
-    merged_with_trajectories_gdf.to_file(parcels_gpkg_output_path, layer='Parcels with CDL pixel trajectories', driver='GPKG', append=True)
+    pyogrio.write_dataframe(merged_with_trajectories_gdf, parcels_gpkg_output_path, layer='Parcels with CDL pixel trajectories', driver='GPKG', append=True)
     
     end_time = time.time()
     print(f'Elapsed time: {end_time - start_time} seconds ({(end_time - start_time) / 60} minutes)')
 
+def _calculate_pixel_trajectories_batch(
+  parcels: list[tuple[Any, str]],
+  reclass_spec: PixelRemapSpecs,
+  clipped_parcels_rasters_folder: str,
+) -> list[tuple[Any, dict[str, int]]]:
+  '''
+  Computes pixel trajectories for a batch of parcels inside a single worker
+  process. Each tuple in `parcels` is (id value, parcel number).
+  '''
+  results: list[tuple[Any, dict[str, int]]] = []
+  for (id_value, parcelnumb) in parcels:
+    result = calculate_pixel_trajectories(
+      f'{clipped_parcels_rasters_folder}/{parcelnumb}',
+      reclass_spec,
+      None, # f'{clipped_parcels_rasters_folder}/{parcelnumb}/trajectories.json',
+      f'./working/temp/trajectories/{parcelnumb}',
+    )
+    results.append((id_value, result))
+  return results
+
 def generate_summary_data(
   consolidated_rasters_list: list[tuple[str, int]],
-  parcels_shp_path: str,
+  parcels_name: str,
+  parcels_gdf: geopandas.GeoDataFrame,
   clipped_parcels_rasters_folder: str,
   id_key: str,
   *,
   status: rich.status.Status
 ) -> Generator[dict[str, object], None, None]:
   """
-  Summarizes the raster data within each parcel in the parcels shapefile and returns
+  Summarizes the raster data within each parcel in the parcels layer and returns
   the results as a list of dictionaries with pixel counts and other metadata.
   """
-  
-  # get the feature count for the shapefile
-  with fiona.open(parcels_shp_path) as source:
-    feature_count = len(list(source))
-    
+
+  feature_count = len(parcels_gdf)
+
+  # hand the workers a pickled copy of the already-parsed parcels frame:
+  # every summarize_raster worker needs the same GeoDataFrame, and unpickling
+  # the pre-parsed frame is much cheaper than re-reading the source layer
+  # in each process
+  pickled_parcels_path = f'./working/temp/{parcels_name}.pkl'
+  os.makedirs(os.path.dirname(pickled_parcels_path), exist_ok=True)
+  parcels_gdf.to_pickle(pickled_parcels_path)
+
+  # precompute each parcel's raster window and geometry mask against the
+  # shared CDL grid (every consolidated raster uses the same grid, so the
+  # rasterization only needs to happen once instead of once per year)
+  feature_windows_path = f'{os.path.splitext(pickled_parcels_path)[0]}__windows.pkl'
+  with alive_bar(title='Precomputing parcel raster windows', monitor=False):
+    compute_feature_windows(consolidated_rasters_list[0][0], parcels_gdf, id_key, feature_windows_path)
+
+
   # calculate the total features to be processed across all years
   total_features = feature_count * len(consolidated_rasters_list)
   
+  # bound the pool: each worker holds its own copy of the parcels frame plus
+  # GDAL raster caches, so the default of one worker per core can exhaust
+  # memory on many-core machines; there is also never a reason to run more
+  # workers than there are yearly rasters. forkserver lets workers inherit
+  # the already-imported modules copy-on-write without fork's GDAL-state risks.
+  workers = min(len(consolidated_rasters_list), max(1, (cpu_count() - 1) // 2))
+
   with alive_bar(total_features, title='Generating summary data') as bar:
     with multiprocess_counter(lambda new_counter_value, old_counter_value: bar(new_counter_value - old_counter_value)) as (shared_counter, lock):
-      with ProcessPoolExecutor() as executor:
+      with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver')) as executor:
         
         # queue each year as a separate process
         futures: list[tuple[int, Future[dict[str, Any]]]] = []
         for (file_path, year) in consolidated_rasters_list:
-          file_root = os.path.splitext(file_path)[0]
           # print(f'Summarizing raster within {parcels_shp_path} for {year}...')
           future =  executor.submit(
                       summarize_raster,
-                      f'{file_root}.tif',
+                      file_path,
                       None,
-                      parcels_shp_path,
+                      pickled_parcels_path,
                       id_key,
                       clipped_parcels_rasters_folder,
+                      feature_windows_path=feature_windows_path,
                       # status=status,
                       # status_prefix=f'[{year}] ',
                       show_progress_bar=False,
@@ -251,22 +328,24 @@ def generate_summary_data(
           futures.append((year, future))
 
         # wait for all futures to complete
-        while bar.current < total_features:
-          time.sleep(0.1)
-                          
-        # yield the results of the futures in the order they were submitted
-        # (we want to preserve order of features in the output layer)
-        for (year, future) in futures:
+        # (the shared-counter callback already advances the bar, so this loop
+        # only needs to surface exceptions as soon as any year's worker fails
+        # instead of polling the bar 10 times per second)
+        future_years = {future: year for (year, future) in futures}
+        for future in as_completed(future_years):
           exception = future.exception()
           if exception:
-            print(f'Error processing {year}: {exception}')
+            print(f'Error processing {future_years[future]}: {exception}')
             raise exception
-          
+
+        # yield the results of the futures in the order they were submitted
+        # (we want to preserve order of features in the output layer)
+        for (year, future) in futures:
           data = future.result()
           if data: yield { 'cropland_year': year, 'data': data }
 
 def join_pixel_counts_to_featurs(
-  parcels_shp_path: geopandas.GeoDataFrame,
+  parcels_gdf: geopandas.GeoDataFrame,
   tidy_df: pandas.DataFrame,
   reclass_spec: PixelRemapSpecs,
   id_key: str,
@@ -281,17 +360,15 @@ def join_pixel_counts_to_featurs(
     pixel_summaries_tidy = tidy_df.copy()
 
     # calcualte a field that is the sum of all developed land classes
-    pixel_summaries_tidy['developed_total'] = \
-      pixel_summaries_tidy['pixel_counts.10'] if 'pixel_counts.10' in pixel_summaries_tidy.columns else 0 + \
-      pixel_summaries_tidy['pixel_counts.11'] if 'pixel_counts.11' in pixel_summaries_tidy.columns else 0 + \
-      pixel_summaries_tidy['pixel_counts.12'] if 'pixel_counts.12' in pixel_summaries_tidy.columns else 0 + \
-      pixel_summaries_tidy['pixel_counts.13'] if 'pixel_counts.13' in pixel_summaries_tidy.columns else 0 + \
-      pixel_summaries_tidy['pixel_counts.14'] if 'pixel_counts.14' in pixel_summaries_tidy.columns else 0
+    # (a single vectorized row-wise reduction over whichever classes are present;
+    # the previous chained ternaries were also wrong because `+` binds tighter
+    # than `if`/`else`, so only the first present class was ever counted)
+    developed_columns = [column for column in (f'pixel_counts.{i}' for i in (10, 11, 12, 13, 14)) if column in pixel_summaries_tidy.columns]
+    pixel_summaries_tidy['developed_total'] = pixel_summaries_tidy[developed_columns].sum(axis=1) if developed_columns else 0
 
     # calcualte a field that is the sum of all cropland and grassland classes
-    pixel_summaries_tidy['cropland_and_grassland_total'] = \
-      pixel_summaries_tidy['pixel_counts.1'] if 'pixel_counts.1' in pixel_summaries_tidy.columns else 0 + \
-      pixel_summaries_tidy['pixel_counts.3'] if 'pixel_counts.3' in pixel_summaries_tidy.columns else 0
+    cropland_and_grassland_columns = [column for column in (f'pixel_counts.{i}' for i in (1, 3)) if column in pixel_summaries_tidy.columns]
+    pixel_summaries_tidy['cropland_and_grassland_total'] = pixel_summaries_tidy[cropland_and_grassland_columns].sum(axis=1) if cropland_and_grassland_columns else 0
 
     # pivot the data so that there is one row for each id
     # and there are two labels for each column
@@ -310,8 +387,7 @@ def join_pixel_counts_to_featurs(
       return f'CDL{year}_{column}'
     pixel_summaries_tidy.columns = pixel_summaries_tidy.columns.map(rename)
 
-    # merge the values of duplicate columns by transposing, grouping by
-    # the first level, summing, and then transposing back
+    # merge the values of duplicate columns
     # (class 254 and class 0 have the same column name)
     pixel_summaries_tidy = pixel_summaries_tidy.T.groupby(level=0).sum().T
 
@@ -324,34 +400,24 @@ def join_pixel_counts_to_featurs(
 
     return pixel_summaries_tidy
 
-  with alive_bar(title='Opening parcels shapefile', monitor=False):
-    parcels_gdf = geopandas.read_file(parcels_shp_path)
-  
   with alive_bar(title='Processing summary columns', monitor=False):
     pixel_summaries_tidy = calculate_and_rename_columns()
   
-  with alive_bar(title='Joining with summary data', monitor=False):  
+  with alive_bar(title='Joining with summary data', monitor=False):
     # merge the pixel summaries data frame with the parcels features
-    merged_gdf = geopandas.GeoDataFrame(
-      parcels_gdf
-        .merge(pixel_summaries_tidy, on=id_key)
-    )
-    
+    # (merging on the GeoDataFrame already yields a GeoDataFrame, so the
+    # result flows straight to the writer without another full copy)
+    merged_gdf = parcels_gdf.merge(pixel_summaries_tidy, on=id_key)
+
   return merged_gdf
   
 def join_pixel_trajectories_to_features(
-  parcels_shp_path: geopandas.GeoDataFrame,
+  parcels_gdf: geopandas.GeoDataFrame,
   trajectories_df: pandas.DataFrame,
   id_key: str,
 ) -> geopandas.GeoDataFrame:
-  with alive_bar(title='Opening parcels shapefile', monitor=False):
-    parcels_gdf = geopandas.read_file(parcels_shp_path)
-  
-  with alive_bar(title='Joining pixel trajectories to features', monitor=False):  
+  with alive_bar(title='Joining pixel trajectories to features', monitor=False):
     # merge the trajectories data frame with the parcels features
-    merged_gdf = geopandas.GeoDataFrame(
-      parcels_gdf
-        .merge(trajectories_df, on=id_key)
-    )
-    
+    merged_gdf = parcels_gdf.merge(trajectories_df, on=id_key)
+
   return merged_gdf
@@ -1,18 +1,54 @@
+import operator
 import os
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import geopandas
+import numpy
 import rasterio
+import rasterio.features
 import rasterio.mask
 import rasterio.warp
 from alive_progress import alive_bar
 
-from clip_raster import clip_raster
-
 
 def __clip_and_save_raster(file_path: str, clip_shape_path: str, out_file_path: str) -> None:
-  out_image, out_transform, out_meta, out_colormap = clip_raster(file_path, clip_shape_path)
+  '''
+  Clips a raster to the first feature of the clip shapefile by reading only
+  the window covering that feature, so per-tile peak memory is bounded by the
+  area of interest instead of the full (national-scale) raster.
+  '''
+  clip_gdf = geopandas.read_file(clip_shape_path, engine='pyogrio', use_arrow=True)
+
+  with rasterio.open(file_path) as raster:
+    # reproject the clip shape to the raster grid
+    geometry = rasterio.warp.transform_geom(
+      src_crs=clip_gdf.crs,
+      dst_crs=raster.crs,
+      geom=[clip_gdf.geometry.iloc[0]],
+    )
+
+    # read only the window covering the area of interest and zero out the
+    # pixels that fall outside the clip shape
+    window = rasterio.features.geometry_window(raster, geometry)
+    window_transform = raster.window_transform(window)
+    out_image = numpy.where(
+      rasterio.features.geometry_mask(geometry, out_shape=(int(window.height), int(window.width)), transform=window_transform, invert=True),
+      raster.read(1, window=window),
+      0,
+    )
+
+    out_colormap = raster.colormap(1)
+    out_meta = raster.meta.copy()
+    out_meta.update({
+                      "driver": "GTiff",
+                      "height": out_image.shape[0],
+                      "width": out_image.shape[1],
+                      "transform": window_transform,
+                      "nodata": 0
+                    })
+
   with rasterio.open(out_file_path, "w", **out_meta) as dest:
-    dest.write(out_image[0], 1)
+    dest.write(out_image, 1)
     dest.write_colormap(1, out_colormap)
 
 def clip_cropscape_to_area_of_interest(input_folder: str = './input', clip_shape_path: str = './input/area_of_interest.shp', output_folder: str = './output') -> None:
@@ -29,14 +65,23 @@ def clip_cropscape_to_area_of_interest(input_folder: str = './input', clip_shape
     os.makedirs(output_folder)
   
   # create a list of files to process
+  # (os.scandir returns dirents with type info cached from a single syscall
+  # per directory, instead of a separate stat call for every entry)
   files_to_process = []
-  for folder in sorted(os.listdir(input_folder)):
-    folder_path = input_folder + '/' + folder
-    if os.path.isdir(folder_path):
-      for filename in sorted(os.listdir(folder_path)):
-        file_path = folder_path + '/' + filename
-        if filename.endswith("_30m_cdls.tif"):
-          files_to_process.append((filename, file_path))
+  for folder_entry in sorted(os.scandir(input_folder), key=operator.attrgetter('name')):
+    if folder_entry.is_dir(follow_symlinks=False):
+      for file_entry in sorted(os.scandir(folder_entry.path), key=operator.attrgetter('name')):
+        if file_entry.name.endswith("_30m_cdls.tif"):
+          # skip tiles whose clipped output is already newer than both the
+          # source raster and the clip shape so that reruns after adding a
+          # new year only clip the new year instead of every year
+          out_file_path = f'{output_folder}/{file_entry.name}'
+          if (
+            os.path.exists(out_file_path)
+            and os.path.getmtime(out_file_path) >= file_entry.stat().st_mtime
+            and os.path.getmtime(out_file_path) >= os.path.getmtime(clip_shape_path)
+          ): continue
+          files_to_process.append((file_entry.name, file_entry.path))
                     
   # clip and save the files to the output folder using multiprocessing
   with alive_bar(len(files_to_process), title='Clipping to AOI') as bar, ProcessPoolExecutor() as executor:
@@ -7,9 +7,11 @@ from typing import Any, Generator
 
 import fiona
 import geopandas
+import pyogrio
 from alive_progress import alive_bar
 from shapely.geometry import shape
 
+from list_layers import list_layers
 from multiprocess_counter import multiprocess_counter
 
 
@@ -54,7 +56,7 @@ def filter_spatial_within(input_layer_path: str, filter_layer_path: str, output_
     
   # if the input is a geopackage, process each layer individually
   if input_layer_path.endswith('.gpkg'):
-    layer_names = sorted(fiona.listlayers(input_layer_path))
+    layer_names = sorted(list_layers(input_layer_path))
     for index, layer_name in enumerate(layer_names):
       if loop_print: print(loop_print.format(chunk_name=layer_name, count=index + 1, total=len(layer_names)))
       process_layer(input_layer_path, filter_layer_path, output_layer_path, invert=invert, layer_name=layer_name, current=index + 1, total=len(layer_names))
@@ -71,13 +73,13 @@ def process_layer(input_layer_path: str, filter_layer_path: str, output_layer_pa
   
   # parse the input and filter layers
   with alive_bar(title='Parsing layers', total=2, monitor=monitor) as bar:
-    filter_layer = fiona.open(filter_layer_path)
-    filter_geom = [shape(feature['geometry']) for feature in filter_layer]
+    # read the filter layer through pyogrio's columnar (Arrow) path instead of
+    # iterating fiona features and building a shapely geometry per dict copy
+    filter_geom = geopandas.read_file(filter_layer_path, engine='pyogrio', use_arrow=True).geometry.values
+    bar()
+
+    input_layer_crs = pyogrio.read_info(input_layer_path, layer=layer_name)['crs']
     bar()
-    
-    with fiona.open(input_layer_path, layer=layer_name) as layer:
-      input_layer_crs = layer.crs
-      bar() 
     
   def batched_records(batch_size: int | None = None) -> Generator[fiona.Feature, None, None]:
     
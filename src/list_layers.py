@@ -0,0 +1,21 @@
+import functools
+
+import pyogrio
+
+
+@functools.lru_cache(maxsize=None)
+def list_layers(dataset_path: str) -> tuple[str, ...]:
+  """
+  Lists the feature layer names in a dataset.
+
+  Each call to fiona.listlayers/pyogrio.list_layers opens the driver, scans
+  the layers, and closes the dataset again, so the result is cached to avoid
+  redundant dataset opens when the same path is queried repeatedly.
+
+  Args:
+    dataset_path (str): The path to the dataset (e.g. geopackage or geodatabase).
+
+  Returns:
+    tuple[str, ...]: The layer names in the dataset.
+  """
+  return tuple(layer_name for (layer_name, geometry_type) in pyogrio.list_layers(dataset_path))
@@ -4,18 +4,32 @@ import math
 import os
 import shutil
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from contextlib import redirect_stdout
 import time
 import traceback
 
-import fiona
+import gdaltools
 import geopandas
 from alive_progress import alive_bar, config_handler
-import pandas
+import pyarrow
+import pyogrio
+import pyogrio.raw
+import shapely
+
+# trade SQLite durability for write speed in every geopackage this pipeline
+# touches: the working files are throwaway and the final output is cheap to
+# regenerate, so per-transaction fsyncs and on-disk journals are pure overhead
+# (these must be set before GDAL is first used; worker processes inherit them)
+os.environ.setdefault('OGR_SQLITE_SYNCHRONOUS', 'OFF')
+os.environ.setdefault('OGR_SQLITE_JOURNAL', 'MEMORY')
+os.environ.setdefault('OGR_SQLITE_CACHE', '1024')
 
 from apply_cdl_data_to_parcels import apply_cdl_data_to_parcels
+from clip_cropscape_to_area_of_interest import clip_cropscape_to_area_of_interest
 from filter_spatial_within import filter_spatial_within
-from reclassify_raster import PixelRemapSpecs
+from list_layers import list_layers
+from reclassify_raster import PixelRemapSpecs, reclassify_rasters
 from regrid_parcels_gdb_to_shp import geodatabases_to_geopackage
 
 class DualStream(io.StringIO):
@@ -59,6 +73,41 @@ reclass_spec: PixelRemapSpecs = {
   255: { 'color': (0, 0, 0), 'name': 'missing', 'original': [] }
 }
 
+def _process_chunk(kwargs: dict) -> None:
+  '''
+  Worker wrapper around apply_cdl_data_to_parcels so that per-chunk keyword
+  argument dicts can be submitted to a process pool.
+  '''
+  apply_cdl_data_to_parcels(**kwargs)
+
+def _write_chunk_layer(table: 'pyarrow.Table', meta: dict, id_key: str, duplicate_ids: set[str], chunked_gpkg_path: str, layer_index: int) -> None:
+  '''
+  Converts one chunk of Arrow rows streamed from the geodatabase into a
+  GeoDataFrame, applies the null/duplicate id fixes, and writes it as
+  layer_{layer_index + 1} of the chunked GeoPackage.
+  '''
+  df = table.to_pandas()
+  geometry = shapely.from_wkb(df.pop(meta['geometry_name'] or 'wkb_geometry'))
+  gdf = geopandas.GeoDataFrame(df, geometry=geometry, crs=meta['crs'])
+  gdf[id_key] = gdf[id_key].astype(str)
+  gdf['INPUT_FID'] = gdf.pop(meta['fid_column']) + 1
+
+  # replace null values with the prefixed value from the fid
+  null_mask = gdf[id_key].isnull()
+  if null_mask.any():  # check if there are any null entries
+    gdf.loc[null_mask, id_key] = 'NULL[[INPUT_FID]]' + gdf.loc[null_mask, 'INPUT_FID'].astype(str)
+
+  # replace values of id_key that are not unique across the whole feature
+  # layer (not just this chunk) with the prefixed value from the fid
+  non_unique_mask = gdf[id_key].isin(duplicate_ids)
+  if non_unique_mask.any():  # check if there are any non-unique entries
+    gdf.loc[non_unique_mask, id_key] = gdf.loc[non_unique_mask, id_key] + '[[INPUT_FID]]' + gdf.loc[non_unique_mask, 'INPUT_FID'].astype(str)
+
+  # rename the id_key column to the first 10 characters
+  gdf = gdf.rename(columns={ id_key: id_key[0:10] })
+
+  pyogrio.write_dataframe(gdf, chunked_gpkg_path, layer=f'layer_{layer_index + 1}', driver='GPKG', append=(layer_index > 0))
+
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description="Read a single parcel feature layer from an ESRI geodatabase, split it into chunks, calculate cropland data layer pixel coverage for each parcel, and the save to a GeoPackage.")
   parser.add_argument('--gdb_path', required=True, type=str, help="Path to the ESRI geodatabase containing parcel data.")
@@ -112,61 +161,60 @@ if __name__ == '__main__':
         # remove working and ouput folders/paths if they exist
         if not args.skip_remove_io:
           if (os.path.isdir('./working')): shutil.rmtree('./working')
-          if (os.path.isdir(args.summary_output_folder_path)):
-            for item in os.listdir(args.summary_output_folder_path):
-              if (os.path.isfile(os.path.join(args.summary_output_folder_path, item))): os.remove(os.path.join(args.summary_output_folder_path, item))
-              else: shutil.rmtree(os.path.join(args.summary_output_folder_path, item))
+          # remove the whole tree in one C-level walk instead of statting and
+          # deleting every child from Python
+          shutil.rmtree(args.summary_output_folder_path, ignore_errors=True)
+          os.makedirs(args.summary_output_folder_path, exist_ok=True)
           if (os.path.exists(args.output_gpkg)): os.remove(args.output_gpkg)
         
         if not args.skip_processing:
-          # read the feature layer from the geodatabase
-          with alive_bar(title='Reading feature layer from geodatabase', monitor=False) as bar:
-            gdb_name = os.path.basename(args.gdb_path)
-            gdf = geopandas.read_file(args.gdb_path, layer=args.layer_name, engine='pyogrio', use_arrow=True, fid_as_index=True, columns=[args.id_key, 'lat', 'lon'])
-            gdf[args.id_key] = gdf[args.id_key].astype(str)
-            gdf['INPUT_FID'] = gdf.index + 1
-            gdf.reset_index(drop=True, inplace=True)
-
-            # replace null values with the prefixed value from ogc_fid or index
-            null_mask = gdf[args.id_key].isnull()
-            if null_mask.any():  # check if there are any null entries
-                if 'INPUT_FID' in gdf.columns:
-                    gdf.loc[null_mask, args.id_key] = 'NULL[[INPUT_FID]]' + gdf.loc[null_mask, 'INPUT_FID'].astype(str)
-                else:
-                    gdf.loc[null_mask, args.id_key] = 'NULL[[index]]' + gdf.loc[null_mask].index.astype(str)
-
-            # replace non-unique values of id_key with the prefixed value from ogc_fid or index
-            non_unique_mask = gdf.duplicated(args.id_key, keep=False)
-            if non_unique_mask.any():  # check if there are any non-unique entries
-              if 'INPUT_FID' in gdf.columns:
-                  gdf.loc[non_unique_mask, args.id_key] = gdf.loc[non_unique_mask, args.id_key] + '[[INPUT_FID]]' + gdf.loc[non_unique_mask, 'INPUT_FID'].astype(str)
-              else:
-                  gdf.loc[non_unique_mask, args.id_key] = gdf.loc[non_unique_mask, args.id_key] + '[[index]]' + gdf.loc[non_unique_mask].index.astype(str)
-
-            # rename the id_key column to the first 10 characters
-            gdf = gdf.rename(columns={ args.id_key: args.id_key[0:10] })
-
-          # split the feature layer into chunks
-          with alive_bar(title='Chunking feature layer', total=math.ceil(len(gdf) / int(args.chunk_size))) as bar:
-            chunks = []
-            for i in range(0, len(gdf), args.chunk_size):
-              chunks.append(gdf.iloc[i:i + args.chunk_size])
-              bar()
-              
-          # save each chunk into a different layer in the GeoPackage
-          with alive_bar(title='Saving chunks to GeoPackage', total=len(chunks)) as bar:
-            chunked_gpkg_path = f'./working/{gdb_name}/{args.layer_name}__chunked.gpkg'
-            filtered_chunked_gpkg_path = f'./working/{gdb_name}/{args.layer_name}__chunked__filtered.gpkg'
-            
-            # create the folder for the GeoPackage
-            if (not os.path.isdir(os.path.dirname(chunked_gpkg_path))):
-              os.makedirs(os.path.dirname(chunked_gpkg_path))
-            
-            # save each chunk into a different layer in the GeoPackage
-            for i, chunk in enumerate(chunks):
-              layer_chunk = f'layer_{i + 1}'
-              chunk.to_file(chunked_gpkg_path, layer=layer_chunk, driver='GPKG', append=True)
-              bar()
+          gdb_name = os.path.basename(args.gdb_path)
+          chunked_gpkg_path = f'./working/{gdb_name}/{args.layer_name}__chunked.gpkg'
+          filtered_chunked_gpkg_path = f'./working/{gdb_name}/{args.layer_name}__chunked__filtered.gpkg'
+
+          # create the folder for the GeoPackage
+          if (not os.path.isdir(os.path.dirname(chunked_gpkg_path))):
+            os.makedirs(os.path.dirname(chunked_gpkg_path))
+
+          # find which id values appear more than once with a cheap
+          # attribute-only read (the per-chunk duplicate fix needs the global
+          # duplicate set, which a streaming read cannot see on its own)
+          with alive_bar(title='Scanning parcel ids', monitor=False) as bar:
+            id_values = pyogrio.read_dataframe(args.gdb_path, layer=args.layer_name, columns=[args.id_key], read_geometry=False, use_arrow=True)[args.id_key].astype(str)
+            duplicate_ids = set(id_values[id_values.duplicated(keep=False)])
+            layer_count = math.ceil(len(id_values) / int(args.chunk_size))
+            del id_values
+
+          # stream the feature layer out of the geodatabase in Arrow record
+          # batches and write every chunk_size rows to their own layer in the
+          # GeoPackage, so peak memory stays O(chunk_size) instead of holding
+          # the whole state-scale layer in one GeoDataFrame
+          with alive_bar(title='Saving chunks to GeoPackage', total=layer_count) as bar:
+            # (use_pyarrow makes the reader yield pyarrow RecordBatches; the
+            # default stream object is not iterable)
+            with pyogrio.raw.open_arrow(args.gdb_path, layer=args.layer_name, columns=[args.id_key, 'lat', 'lon'], return_fids=True, use_pyarrow=True) as (meta, reader):
+              layer_index = 0
+              buffered_batches = []
+              buffered_rows = 0
+
+              for batch in reader:
+                buffered_batches.append(batch)
+                buffered_rows += batch.num_rows
+
+                # write full chunk_size slices out of the buffer, keeping any
+                # remainder rows for the next layer (arrow slices are zero-copy)
+                while buffered_rows >= args.chunk_size:
+                  table = pyarrow.Table.from_batches(buffered_batches)
+                  _write_chunk_layer(table.slice(0, args.chunk_size), meta, args.id_key, duplicate_ids, chunked_gpkg_path, layer_index)
+                  remainder = table.slice(args.chunk_size)
+                  buffered_batches = remainder.to_batches()
+                  buffered_rows = remainder.num_rows
+                  layer_index += 1
+                  bar()
+
+              if buffered_rows > 0:
+                _write_chunk_layer(pyarrow.Table.from_batches(buffered_batches), meta, args.id_key, duplicate_ids, chunked_gpkg_path, layer_index)
+                bar()
                         
           # create a new geopackage without urban area parcels
           if (args.filter_layer_path):
@@ -180,60 +228,69 @@ if __name__ == '__main__':
                   
           # create a list of the chunked layers by reading the GeoPackage
           gpkg_path = filtered_chunked_gpkg_path if args.filter_layer_path else chunked_gpkg_path
-          chunk_names = fiona.listlayers(gpkg_path)
-          
-          # create temporary shapefile versions of each chunk since `apply_cdl_data_to_parcels` requires shapefiles
-          print(f'\n{"─" * max_cols}')
-          with alive_bar(len(chunk_names), title='Saving chunks to shapefiles') as bar:
-            for chunk_name in chunk_names:
-              chunk_gdf = geopandas.read_file(gpkg_path, layer=chunk_name, engine='pyogrio', use_arrow=True)
-              chunk_gdf[args.id_key[0:10]] = chunk_gdf[args.id_key[0:10]].astype(str)
-              chunk_gdf.to_file(f'./working/{gdb_name}/{args.layer_name}__{chunk_name}.shp')
-              bar()
+          chunk_names = list_layers(gpkg_path)
           
-          # for each chunk, process the feature layer
-          for index, chunk_name in enumerate(chunk_names):
-            print(f'\n{"─" * max_cols}\nProcessing chunk "{chunk_name}" for summaries ({index + 1}/{len(chunk_names)})...')
-
-            parcels_gpkg_output_path=f'{args.summary_output_folder_path}/chunked/{args.layer_name}__{chunk_name}__output.gpkg'
-            os.makedirs(os.path.dirname(parcels_gpkg_output_path), exist_ok=True)
-            
-            apply_cdl_data_to_parcels(
+          # clip and reclassify the cropland data layer rasters once up front
+          # (this work is shared by every chunk, so doing it here lets all of
+          # the chunk workers below skip straight to the parcel processing)
+          print(f'\n{"─" * max_cols}\nPreparing cropland data layer rasters...')
+          clip_cropscape_to_area_of_interest(args.cdls_folder_path, args.cdls_aoi_shp_path, './working/clipped')
+          reclassify_rasters('./working/clipped', './working/consolidated', reclass_spec)
+
+          # build the keyword arguments for each chunk
+          os.makedirs(f'{args.summary_output_folder_path}/chunked', exist_ok=True)
+          chunk_kwargs = [
+            dict(
               cropscape_input_folder=args.cdls_folder_path, # folder containing cropland data layer rasters folders
               area_of_interest_shapefile=args.cdls_aoi_shp_path, # shapefile defining area of interest
               clipped_rasters_folder='./working/clipped', # folder for rasters clipped to area of interest
               consolidated_rasters_folder='./working/consolidated', # folder for consolidated cropland data layer rasters
               reclass_spec=reclass_spec,
-              parcels_shp_path=f'./working/{gdb_name}/{args.layer_name}__{chunk_name}.shp',
+              parcels_source=(gpkg_path, chunk_name), # chunk layer in the chunked geopackage
               id_key=args.id_key[:10],
               parcels_summary_file=f'{args.summary_output_folder_path}/chunked/{chunk_name}__summary_data.json',
               clipped_parcels_rasters_folder='./working/clipped_parcels_rasters',
               parcels_trajectories_file=f'{args.summary_output_folder_path}/chunked/{chunk_name}__trajectories.json',
-              parcels_gpkg_output_path=parcels_gpkg_output_path,
-              skip_raster_clipping_and_reclassifying=index > 0,
-              skip_trajectories=True
+              parcels_gpkg_output_path=f'{args.summary_output_folder_path}/chunked/{args.layer_name}__{chunk_name}__output.gpkg',
+              skip_raster_clipping_and_reclassifying=True
             )
+            for chunk_name in chunk_names
+          ]
 
-          for index, chunk_name in enumerate(chunk_names):
-            print(f'\n{"─" * max_cols}\nProcessing chunk "{chunk_name}" for trajectories ({index + 1}/{len(chunk_names)})...')
+          # each chunk writes to its own geopackage, summary, and trajectory
+          # paths, so the chunks can run concurrently; cap the pool at half the
+          # cores because apply_cdl_data_to_parcels runs its own worker pools
+          # internally
+          workers = max(1, min(len(chunk_names), os.cpu_count() // 2))
 
-            parcels_gpkg_output_path=f'{args.summary_output_folder_path}/chunked/{args.layer_name}__{chunk_name}__output.gpkg'
-            
-            apply_cdl_data_to_parcels(
-              cropscape_input_folder=args.cdls_folder_path, # folder containing cropland data layer rasters folders
-              area_of_interest_shapefile=args.cdls_aoi_shp_path, # shapefile defining area of interest
-              clipped_rasters_folder='./working/clipped', # folder for rasters clipped to area of interest
-              consolidated_rasters_folder='./working/consolidated', # folder for consolidated cropland data layer rasters
-              reclass_spec=reclass_spec,
-              parcels_shp_path=f'./working/{gdb_name}/{args.layer_name}__{chunk_name}.shp',
-              id_key=args.id_key[:10],
-              parcels_summary_file=f'{args.summary_output_folder_path}/chunked/{chunk_name}__summary_data.json',
-              clipped_parcels_rasters_folder='./working/clipped_parcels_rasters',
-              parcels_trajectories_file=f'{args.summary_output_folder_path}/chunked/{chunk_name}__trajectories.json',
-              parcels_gpkg_output_path=parcels_gpkg_output_path,
-              skip_raster_clipping_and_reclassifying=True,
-              skip_summary_data=True
-            )
+          # weight each chunk by its feature count so the bars below advance
+          # by the fraction of parcels finished instead of one opaque tick per
+          # multi-minute chunk, making stalled workers visible
+          chunk_weights = {chunk_name: pyogrio.read_info(gpkg_path, layer=chunk_name)['features'] for chunk_name in chunk_names}
+          total_weight = max(sum(chunk_weights.values()), 1)
+
+          # process every chunk for summaries, then every chunk for
+          # trajectories (the trajectories pass reads the per-parcel rasters
+          # that the summaries pass writes)
+          print(f'\n{"─" * max_cols}\nProcessing {len(chunk_names)} chunks for summaries...')
+          with alive_bar(title='Processing chunks (summaries)', manual=True) as bar:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+              futures = {executor.submit(_process_chunk, { **kwargs, 'skip_trajectories': True }): chunk_name for (chunk_name, kwargs) in zip(chunk_names, chunk_kwargs)}
+              processed_weight = 0
+              for future in as_completed(futures):
+                future.result()
+                processed_weight += chunk_weights[futures[future]]
+                bar(processed_weight / total_weight)
+
+          print(f'\n{"─" * max_cols}\nProcessing {len(chunk_names)} chunks for trajectories...')
+          with alive_bar(title='Processing chunks (trajectories)', manual=True) as bar:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+              futures = {executor.submit(_process_chunk, { **kwargs, 'skip_summary_data': True }): chunk_name for (chunk_name, kwargs) in zip(chunk_names, chunk_kwargs)}
+              processed_weight = 0
+              for future in as_completed(futures):
+                future.result()
+                processed_weight += chunk_weights[futures[future]]
+                bar(processed_weight / total_weight)
         
         if not args.skip_merge:
           print(f'\n{"─" * max_cols}\nMerging chunked layers into "{args.output_gpkg}"...')
@@ -250,37 +307,26 @@ if __name__ == '__main__':
                 chunk_names.append(chunk_name)
                 break
 
-          # merge all the chunked layers into a single layer
-          merged_counts_gdf = geopandas.GeoDataFrame()
-          merged_trajectories_gdf = geopandas.GeoDataFrame()
+          # append each chunk's layers into the output GeoPackage with ogr2ogr
+          # (matching the append pattern in regrid_parcels_gdb_to_shp.py):
+          # the features stream straight between the geopackages in GDAL
+          # instead of being read into Python, concatenated, and written back
           with alive_bar(2 * len(chunk_names), title='Merging chunked layers') as bar:
             for chunk_name in chunk_names:
               chunk_path = f'{args.summary_output_folder_path}/chunked/{args.layer_name}__{chunk_name}__output.gpkg'
 
               if (os.path.exists(chunk_path)):
-                try:
-                  chunk_counts_gdf = geopandas.read_file(chunk_path, layer='Parcels with CDL counts', engine='pyogrio', use_arrow=True)
-                  chunk_counts_gdf[args.id_key[0:10]] = chunk_counts_gdf[args.id_key[0:10]].astype(str)
-                  merged_counts_gdf = pandas.concat([merged_counts_gdf, chunk_counts_gdf], ignore_index=True)
-                  bar()
-                except:
-                  print(f'Error reading {chunk_path} layer "Parcels with CDL counts"')
-              
-                try:
-                  chunk_trajectories_gdf = geopandas.read_file(chunk_path, layer='Parcels with CDL pixel trajectories', engine='pyogrio', use_arrow=True)
-                  chunk_trajectories_gdf[args.id_key[0:10]] = chunk_trajectories_gdf[args.id_key[0:10]].astype(str)
-                  merged_trajectories_gdf = pandas.concat([merged_trajectories_gdf, chunk_trajectories_gdf], ignore_index=True)
-                  bar()
-                except:
-                  print(f'Error reading {chunk_path} layer "Parcels with CDL pixel trajectories"')
-                
-            
-          # save merged layers to the output GeoPackage
-          with alive_bar(2, title='Saving merged layers', monitor=False) as bar:
-            merged_counts_gdf.to_file(args.output_gpkg, layer='Parcels with CDL counts', driver='GPKG')
-            bar()
-            merged_trajectories_gdf.to_file(args.output_gpkg, layer='Parcels with CDL pixel trajectories', driver='GPKG')
-            bar()
+                for merged_layer_name in ('Parcels with CDL counts', 'Parcels with CDL pixel trajectories'):
+                  try:
+                    ogr = gdaltools.ogr2ogr()
+                    ogr.set_encoding("UTF-8")
+                    if os.path.exists(args.output_gpkg): ogr.set_output_mode('AP', 'UP') # append mode once the output geopackage exists
+                    ogr.set_input(chunk_path, merged_layer_name)
+                    ogr.set_output(args.output_gpkg, 'GPKG', merged_layer_name)
+                    ogr.execute()
+                    bar()
+                  except:
+                    print(f'Error reading {chunk_path} layer "{merged_layer_name}"')
 
         print(f'\n{"─" * max_cols}\nDONE')
         print(f'  Total elapsed time: {time.strftime("%H:%M:%S", time.gmtime(time.time() - start_time))}')
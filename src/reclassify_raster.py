@@ -1,4 +1,5 @@
-import copy
+import multiprocessing
+import operator
 import os
 from concurrent.futures import Future, ProcessPoolExecutor, as_completed
 from time import sleep
@@ -12,44 +13,68 @@ from alive_progress import alive_bar
 PixelRemapSpec = TypedDict('PixelRemapSpec', {'color': tuple[int, int, int], 'name': str, 'original': list[int]})
 PixelRemapSpecs = dict[int, PixelRemapSpec]
 
-def reclassify_raster(input_raster_path: str, output_raster_path: str, remap: PixelRemapSpecs) -> numpy.typing.NDArray[Any]:
+def _enter_gdal_env() -> None:
+  '''
+  Enter a shared rasterio/GDAL environment for the current worker process.
+
+  This is used as a ProcessPoolExecutor initializer so that the driver
+  registration, header cache, and VSI cache are paid for once per worker
+  instead of once per raster open/close.
+  '''
+  rasterio.Env(GDAL_CACHEMAX=64, GDAL_NUM_THREADS='ALL_CPUS', VSI_CACHE=True, VSI_CACHE_SIZE=1000000).__enter__()
+
+def build_reclass_lut(remap: PixelRemapSpecs) -> numpy.typing.NDArray[numpy.uint8]:
+  '''
+  Bake the reclassification specification into a 256-entry uint8 lookup table
+  so that reclassifying a band is a single vectorized gather (lut[band]).
+  Pixel values without a remap specification pass through unchanged.
+  '''
+  lut = numpy.arange(256, dtype=numpy.uint8)
+  # assign the specs in reverse so that when two specs claim the same original
+  # value the FIRST spec in the remap wins, matching the sequential remap
+  # behavior (e.g. original value 190 belongs to wetlands, listed before
+  # woody_wetlands, in the spec in main.py)
+  for key, value in reversed(remap.items()):
+    lut[value['original']] = numpy.uint8(key)
+  return lut
+
+def reclassify_raster(input_raster_path: str, output_raster_path: str, remap: PixelRemapSpecs, lut: numpy.typing.NDArray[numpy.uint8] | None = None) -> numpy.typing.NDArray[Any]:
   """
   Reclassify raster data based on the provided reclassification specification.
-  
+
   Args:
     input_raster_path (str): the path to the input raster file
     output_raster_path (str): the path to the output raster file
     remap (PixelRemapSpecs): the reclassification specification
-    
+    lut (NDArray[uint8] | None): a prebuilt lookup table from build_reclass_lut. If None, one is built from remap.
+
   Type Hints:
     PixelRemapSpec: TypedDict('PixelRemapSpec', {'color': tuple[int, int, int], 'name': str, 'original': list[int]})
     PixelRemapSpecs: dict[int, PixelRemapSpec]
-    
+
   Returns:
     the reclassified raster data
   """
   # open the raster and lock it in the filesystem while working on it
   with rasterio.open(input_raster_path) as raster:
     band1: numpy.typing.NDArray[Any] = raster.read(1)
-        
-    # reclassify based on the provided specifications
-    reclassified = copy.deepcopy(band1)
-    for key, value in remap.items():
-      # reclass to negative number so that it will not be changed to a value
-      # that is used in a different remap specification
-      # (we will covert back to positive values once we are done with the loop)
-      reclassified = numpy.where(numpy.isin(reclassified, value['original']), key * -1, reclassified)
-      
-    # convert the negative values back to positive values
-    reclassified = numpy.absolute(reclassified)
-    
+
+    # reclassify based on the provided specifications by applying the lookup
+    # table as a single vectorized gather
+    # (CDL classes fit in 8 bits, so staying uint8 end-to-end halves the memory
+    # bandwidth compared to the signed integer intermediates we used before)
+    if lut is None:
+      lut = build_reclass_lut(remap)
+    reclassified = lut[band1]
+
     # calculate the colormap based on the remap specification
     colormap = {key: value['color'] for key, value in remap.items()}
-    
+
     # export the extracted band pixel values
     # with the extracted band as black pixels and the rest as transparent white pixels
     out_profile = raster.profile.copy()
-    out_profile.update(nodata=0)
+    # IF_SAFER avoids a second write pass when a tile would exceed 4 GB
+    out_profile.update(nodata=0, dtype='uint8', BIGTIFF='IF_SAFER')
     with rasterio.open(output_raster_path, "w", **out_profile) as dest:
       dest.write(reclassified, 1)
       dest.write_colormap(1, colormap)
@@ -77,23 +102,32 @@ def reclassify_rasters(input_folder: str, output_folder: str, remap: PixelRemapS
     os.makedirs(output_folder)
     
   # create a list of files to process
+  # (os.scandir avoids an extra stat call per entry, which adds up on network filesystems)
   files_to_process = []
-  for filename in sorted(os.listdir(input_folder)):
-    file_path = input_folder + '/' + filename
-    if filename.endswith(".tif") or filename.endswith(".tiff"):
-      files_to_process.append((filename, file_path))
-          
+  with os.scandir(input_folder) as entries:
+    for entry in entries:
+      if entry.name.endswith(".tif") or entry.name.endswith(".tiff"):
+        files_to_process.append((entry.name, entry.path))
+  files_to_process.sort(key=operator.itemgetter(0))
+
+  # build the lookup table once for the whole batch so each worker applies it
+  # directly instead of rebuilding it per raster
+  lut = build_reclass_lut(remap)
+
   # reclssify and save the rasters to the output folder using multiprocessing
   with alive_bar(len(files_to_process), title='Reclassifying rasters', disable=not show_progress_bar) as bar:
     
     if use_multiprocessing:
-      with ProcessPoolExecutor() as executor:
+      # deliberately use spawn instead of the platform default: forked workers
+      # inherit the parent's GDAL state and can each hold a duplicated cache,
+      # while spawned workers start clean and set up their own via the initializer
+      with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('spawn'), initializer=_enter_gdal_env) as executor:
         futures: list[Future[numpy.typing.NDArray[Any]]] = []
         
         # queue each function to be executed
         for filename, file_path in files_to_process:
           out_file_path = f'{output_folder}/{filename}'
-          future = executor.submit(reclassify_raster, file_path, out_file_path, remap)
+          future = executor.submit(reclassify_raster, file_path, out_file_path, remap, lut)
           futures.append(future)
           sleep(1)
             
@@ -104,6 +138,6 @@ def reclassify_rasters(input_folder: str, output_folder: str, remap: PixelRemapS
     else:
       for filename, file_path in files_to_process:
         out_file_path = f'{output_folder}/{filename}'
-        reclassify_raster(file_path, out_file_path, remap)
+        reclassify_raster(file_path, out_file_path, remap, lut)
         bar()
   
\ No newline at end of file
@@ -1,9 +1,37 @@
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
 
-import fiona
 import gdaltools
+import pyogrio
 from alive_progress import alive_bar, alive_it
 
+from list_layers import list_layers
+
+
+def _convert_one(geodatabase_path: str, temp_gpkg_path: str, srs: str, columns_to_parse: list[str]) -> str:
+  """
+  Converts a single geodatabase into its own temporary GeoPackage.
+  Runs in a worker process so that multiple geodatabases convert concurrently.
+
+  Returns:
+    str: The name of the converted feature layer.
+  """
+  layer_name = list_layers(geodatabase_path)[0]
+
+  ogr = gdaltools.ogr2ogr()
+  ogr.set_encoding("UTF-8")
+
+  ogr.set_input(geodatabase_path, layer_name)
+  ogr.set_output(temp_gpkg_path, 'GPKG', layer_name, srs)
+
+  # limit the attribute table columns to only the ones we want
+  # to increase processing speeds
+  ogr.set_sql(f'SELECT {", ".join(columns_to_parse)} FROM {layer_name}')
+
+  ogr.execute()
+  return layer_name
 
 def geodatabases_to_geopackage(geodatabases_folder_path: str, output_gpkg_path: str, *, columns_to_parse: list[str] = ['parcelnumb_no_formatting', 'lat', 'lon']) -> str: 
   """
@@ -27,30 +55,44 @@ def geodatabases_to_geopackage(geodatabases_folder_path: str, output_gpkg_path:
   if (not os.path.isdir(output_folder_path)): 
     os.makedirs(output_folder_path)
   
-  geodatabase_paths = [f'{geodatabases_folder_path}/{name}' for name in os.listdir(geodatabases_folder_path) if name.endswith('.gdb')]
+  with os.scandir(geodatabases_folder_path) as entries:
+    geodatabase_paths = [entry.path for entry in entries if entry.name.endswith('.gdb')]
   geodatabase_paths_length = len(geodatabase_paths)
   print(f'Found {geodatabase_paths_length} geodatabase files in {geodatabases_folder_path}')
   
   # determine the target crs
-  layer_info = str(gdaltools.ogrinfo(geodatabase_paths[0], fiona.listlayers(geodatabase_paths[0])[0], summary=True, fields=False))
-  epsg_index = layer_info.index('ID["EPSG"')
-  srs = layer_info[epsg_index+4:epsg_index+14].replace('",', ':')
+  # (read_info returns the 'EPSG:xxxx' string straight from GDAL instead of
+  # forking an ogrinfo process and fishing the code out of its WKT dump)
+  srs = pyogrio.read_info(geodatabase_paths[0], layer=list_layers(geodatabase_paths[0])[0])['crs']
     
+  # convert each geodatabase into its own temporary geopackage in parallel
+  # (appends into a single geopackage are serialized by SQLite's writer lock,
+  # so the expensive conversion work runs in per-geodatabase files and the
+  # combined geopackage is produced with a quick append pass afterwards)
+  temp_folder_path = f'{output_folder_path}/temp_gpkgs'
+  if (not os.path.isdir(temp_folder_path)):
+    os.makedirs(temp_folder_path)
+  temp_gpkg_paths = [f'{temp_folder_path}/{index}.gpkg' for index in range(geodatabase_paths_length)]
+
+  with alive_bar(geodatabase_paths_length, title='Converting geodatabases') as bar:
+    with ProcessPoolExecutor(max_workers=min(geodatabase_paths_length, cpu_count())) as executor:
+      futures = [executor.submit(_convert_one, geodatabase_path, temp_gpkg_path, srs, columns_to_parse) for geodatabase_path, temp_gpkg_path in zip(geodatabase_paths, temp_gpkg_paths)]
+      for future in as_completed(futures):
+        bar()
+  layer_names = [future.result() for future in futures]
+
   # create the combined geopackage
-  for index, geodatabase_path in enumerate(alive_it(geodatabase_paths, title='Merging geodatabases')):
-    layer_name = fiona.listlayers(geodatabase_path)[0]
-    
+  for index, (temp_gpkg_path, layer_name) in enumerate(alive_it(list(zip(temp_gpkg_paths, layer_names)), title='Merging geodatabases')):
     ogr = gdaltools.ogr2ogr()
     ogr.set_encoding("UTF-8")
     if index > 0: ogr.set_output_mode('AP', 'UP') # append mode for all but the first geodatabase
-    
-    ogr.set_input(geodatabase_path, layer_name)
+
+    ogr.set_input(temp_gpkg_path, layer_name)
     ogr.set_output(output_gpkg_path, 'GPKG', layer_name, srs)
-    
-    # limit the attribute table columns to only the ones we want
-    # to increase processing speeds
-    ogr.set_sql(f'SELECT {", ".join(columns_to_parse)} FROM {layer_name}') 
-  
+
     ogr.execute()
-      
+
+  # clean up the temporary per-geodatabase geopackages
+  shutil.rmtree(temp_folder_path)
+
   return output_gpkg_path
@@ -1,23 +1,33 @@
 import functools
-import json
+import math
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
 from multiprocessing.managers import SyncManager, ValueProxy
 import os
-import shutil
+import pickle
 from typing import Any, Optional
 
 from alive_progress import alive_bar
+import affine
 import geopandas
 import numpy
+import orjson
+import pandas
 import rasterio
+import rasterio.features
+import rasterio.warp
+import rasterio.windows
 import rich
 from rasterio.io import DatasetReader
 from rich.status import Status
 
 from clip_raster import clip_raster
 
+FeatureWindow = tuple[rasterio.windows.Window, affine.Affine, numpy.ndarray]
+
 console = rich.console.Console()
 
-def summarize_raster(input_raster_path: str, summary_output_path: str | None = None, feature_layer_path: str | None = None, id_key: str | None = None, breakdown_output_folder_path: str | None = None, *, status: Status | None = None, status_prefix: str = '', show_progress_bar: bool = False, shared_counter: Optional[ValueProxy[int]] = None, lock: Optional[SyncManager.Lock] = None) -> dict[str, Any]:
+def summarize_raster(input_raster_path: str, summary_output_path: str | None = None, feature_layer_path: str | None = None, id_key: str | None = None, breakdown_output_folder_path: str | None = None, *, feature_windows_path: str | None = None, status: Status | None = None, status_prefix: str = '', show_progress_bar: bool = False, shared_counter: Optional[ValueProxy[int]] = None, lock: Optional[SyncManager.Lock] = None) -> dict[str, Any]:
   '''
   Generate summary metadata for an input raster.
   - pixel counts for each class
@@ -48,18 +58,23 @@ def summarize_raster(input_raster_path: str, summary_output_path: str | None = N
     raster: DatasetReader = rasterio.open(input_raster_path)
   if status: status.console.log(f'{status_prefix}Raster opened')
       
-  # we only look at band 1 -- multiband rasters are not supported
-  band1: numpy.ndarray[Any, Any] = raster.read(1)
-      
   # count the number of pixels for each class and put them into a dictionary
+  # (we only look at band 1 -- multiband rasters are not supported)
   if status: status.update(f'{status_prefix}Parsing raster pixels...')
   with alive_bar(title='Counting pixels', disable=not show_progress_bar, monitor=False) as bar:
-    clipped_pixel_classes, clipped_pixel_counts = numpy.unique(band1, return_counts=True)
-    clipped_pixel_class_counts = dict(zip(clipped_pixel_classes.tolist(), clipped_pixel_counts.tolist()))
+    # accumulate the histogram block-by-block so the whole band never has to
+    # be resident in memory at once; bincount histograms the 256 possible
+    # classes in a single unsorted pass, unlike numpy.unique which sorts
+    # the whole band first
+    clipped_pixel_counts = numpy.zeros(256, dtype=numpy.int64)
+    for (block_index, window) in raster.block_windows(1):
+      clipped_pixel_counts += numpy.bincount(raster.read(1, window=window).ravel(), minlength=256)
+    # only box the handful of classes that actually occur into Python ints
+    clipped_pixel_class_counts = {int(pixel_class): int(clipped_pixel_counts[pixel_class]) for pixel_class in numpy.flatnonzero(clipped_pixel_counts)}
   if status: status.console.log(f'{status_prefix}Raster pixels parsed')
   
   if feature_layer_path and id_key:
-    breakdown_metadata = process_feature_layer(raster, feature_layer_path, id_key, breakdown_output_folder_path, status=status, status_prefix=status_prefix, show_progress_bar=show_progress_bar, shared_counter=shared_counter, lock=lock)
+    breakdown_metadata = process_feature_layer(raster, feature_layer_path, id_key, breakdown_output_folder_path, feature_windows_path=feature_windows_path, status=status, status_prefix=status_prefix, show_progress_bar=show_progress_bar, shared_counter=shared_counter, lock=lock)
   else:
     breakdown_metadata = None
   
@@ -75,9 +90,10 @@ def summarize_raster(input_raster_path: str, summary_output_path: str | None = N
   # save the feature metadata to json
   if summary_output_path:
     if status: status.update(f'{status_prefix}Saving metadata...')
-    with open(summary_output_path, "w") as file:
+    with open(summary_output_path, "wb") as file:
       with alive_bar(title='Saving summary metadata', disable=not show_progress_bar) as bar:
-        json.dump(feature_metadata, file, indent=2) 
+        # the pixel count keys are ints, so OPT_NON_STR_KEYS keeps them intact
+        file.write(orjson.dumps(feature_metadata, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
         bar()
       if status: status.console.log(f'{status_prefix}Metadata saved to {summary_output_path}')
   
@@ -86,96 +102,218 @@ def summarize_raster(input_raster_path: str, summary_output_path: str | None = N
   
   return feature_metadata
 
+def _zonal_pixel_class_counts(raster: DatasetReader, feature_layer: geopandas.GeoDataFrame) -> numpy.ndarray:
+  '''
+  Compute per-feature pixel class counts for the whole raster in a single
+  vectorized pass.
+
+  The feature positions (+1) are rasterized into a zone raster aligned to the
+  input grid, each pixel's zone and class are combined into one flat key, and
+  the keys are histogrammed with a single numpy.bincount call instead of
+  clipping and counting once per feature.
+
+  Returns:
+    numpy.ndarray: An array of shape (len(feature_layer) + 1, 256) where row
+    i + 1 holds the pixel class counts for feature i and row 0 holds the
+    counts for pixels outside every feature.
+  '''
+  # reproject the features to the raster grid
+  reprojected_geometries = rasterio.warp.transform_geom(
+    src_crs=feature_layer.crs,
+    dst_crs=raster.crs,
+    geom=feature_layer.geometry.values,
+  )
+
+  zones = rasterio.features.rasterize(
+    ((geometry, zone) for zone, geometry in enumerate(reprojected_geometries, start=1)),
+    out_shape=(raster.height, raster.width),
+    transform=raster.transform,
+    dtype='uint32',
+  )
+
+  # accumulate the histogram over block windows so only the uint32 zone
+  # raster is ever resident at full size (reading the whole band plus two
+  # full-raster int64 key arrays at once multiplies badly across the
+  # concurrent per-year and per-chunk workers); the flat zone*256+class keys
+  # stay uint32 since the largest key is (features + 1) * 256 - 1
+  counts = numpy.zeros((len(feature_layer) + 1) * 256, dtype=numpy.int64)
+  for (block_index, window) in raster.block_windows(1):
+    (row_slice, col_slice) = window.toslices()
+    flat_keys = zones[row_slice, col_slice] * numpy.uint32(256) + raster.read(1, window=window)
+    counts += numpy.bincount(flat_keys.ravel(), minlength=counts.size)
+  return counts.reshape(-1, 256)
+
+def compute_feature_windows(sample_raster_path: str, feature_layer: geopandas.GeoDataFrame, id_key: str, output_pickle_path: str) -> str:
+  '''
+  Precompute the raster window, window transform, and geometry mask for every
+  feature in the feature layer against a sample raster grid, and pickle the
+  result so that worker processes can reuse it.
+
+  All consolidated cropland data layer rasters share the same grid, so the
+  windows and masks only need to be computed once and can then be reused for
+  every year instead of re-rasterizing identical geometry year after year.
+
+  Returns:
+    str: The path to the pickled windows dictionary (id -> (window, transform, mask)).
+  '''
+  windows: dict[str, FeatureWindow] = {}
+  with rasterio.open(sample_raster_path) as raster:
+    # reproject the features to the raster grid once
+    reprojected_geometries = rasterio.warp.transform_geom(
+      src_crs=feature_layer.crs,
+      dst_crs=raster.crs,
+      geom=feature_layer.geometry.values,
+    )
+
+    for (id, geometry) in zip(feature_layer[id_key], reprojected_geometries):
+      window = rasterio.features.geometry_window(raster, [geometry])
+      window_transform = raster.window_transform(window)
+      geometry_mask = rasterio.features.geometry_mask([geometry], out_shape=(int(window.height), int(window.width)), transform=window_transform, invert=True)
+      windows[id] = (window, window_transform, geometry_mask)
+
+  with open(output_pickle_path, 'wb') as file:
+    pickle.dump(windows, file)
+
+  return output_pickle_path
+
+@functools.cache
+def _load_feature_windows(windows_pickle_path: str) -> dict[str, FeatureWindow]:
+  '''
+  Load precomputed feature windows from a pickle file.
+  This function's result is cached so each worker process unpickles once.
+  '''
+  with open(windows_pickle_path, 'rb') as file:
+    return pickle.load(file)
+
 @functools.cache
-def read_feature_layer(feature_layer_path: str, id_key: str) -> geopandas.GeoDataFrame:
+def read_feature_layer(feature_layer_path: str, id_key: str, *, layer: str | None = None, where: str | None = None) -> geopandas.GeoDataFrame:
   '''
   Open a feature layer from file path and return it as a GeoDataFrame.
+  A pickled GeoDataFrame (.pkl) is loaded directly, which lets callers parse
+  a layer once and share the pre-parsed frame with many worker processes
+  instead of re-reading and re-decoding the source file in each of them.
+  For multi-layer sources (e.g. geopackages), `layer` selects the layer.
+  An optional `where` attribute filter (OGR SQL, e.g. "STATEFP = '45'") is
+  pushed down to GDAL so that rows it excludes are never read or decoded,
+  instead of being materialized and then dropped in pandas.
   This function's result is cached to prevent multiple reads of the same file.
   '''
-  gdf = geopandas.read_file(feature_layer_path, engine='pyogrio', use_arrow=True)
+  if feature_layer_path.endswith('.pkl'):
+    return pandas.read_pickle(feature_layer_path)
+  gdf = geopandas.read_file(feature_layer_path, layer=layer, where=where, engine='pyogrio', use_arrow=True)
   gdf[id_key] = gdf[id_key].astype(str)
   return gdf
   
-def process_feature_layer(raster: DatasetReader, feature_layer_path: str, id_key: str, output_folder_path: str | None = None, *, status: Status | None = None, status_prefix: str = '', show_progress_bar: bool = False, shared_counter: Optional[ValueProxy[int]] = None, lock: Optional[SyncManager.Lock] = None) -> list[dict[str, Any]]:
-  raster_root, raster_ext = os.path.splitext(raster.name)
-  raster_name = os.path.basename(raster_root)
-  feature_layer_root, feature_layer_ext = os.path.splitext(feature_layer_path)
-  feature_layer_name = os.path.basename(feature_layer_root)
-      
+def _write_feature_outputs(features: list[tuple[Any, dict[str, Any]]], raster_path: str, feature_layer_path: str, id_key: str, output_folder_path: str, feature_windows_path: str | None, shared_counter: Optional[ValueProxy[int]] = None, lock: Optional[SyncManager.Lock] = None) -> int:
+  '''
+  Writes the metadata json and clipped raster for a batch of features inside
+  a worker process. Each tuple in `features` is (row index, feature metadata).
+  The raster is reopened from its path because open GDAL datasets cannot be
+  pickled across process boundaries.
+  '''
+  raster_name = os.path.basename(os.path.splitext(raster_path)[0])
+  feature_layer_name = os.path.basename(os.path.splitext(feature_layer_path)[0])
+
+  with rasterio.open(raster_path) as raster:
+    for (index, feature_metadata) in features:
+      id = feature_metadata['id']
+      output_folder = f'{output_folder_path}/{id}'
+      output_raster_file = f'{output_folder}/{raster_name}__{feature_layer_name}.tiff'
+      output_json_file = f'{output_folder}/{raster_name}__{feature_layer_name}.json'
+      os.makedirs(output_folder, exist_ok=True)
+
+      # save the feature metadata to json
+      with open(output_json_file, "wb") as file:
+        file.write(orjson.dumps(feature_metadata, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+
+      # clip the raster to the feature
+      if feature_windows_path:
+        # reuse the precomputed window and geometry mask for this feature:
+        # the windowed read plus mask fill produces the same bbox-cropped,
+        # outside-zeroed array as rasterio.mask without re-rasterizing the
+        # feature geometry for every year
+        (window, window_transform, geometry_mask) = _load_feature_windows(feature_windows_path)[id]
+        clipped_band1 = numpy.where(geometry_mask, raster.read(1, window=window), 0)
+        out_colormap = raster.colormap(1)
+        out_meta = raster.meta.copy()
+        out_meta.update({
+                          "driver": "GTiff",
+                          "height": clipped_band1.shape[0],
+                          "width": clipped_band1.shape[1],
+                          "transform": window_transform,
+                          "nodata": 0
+                        })
+      else:
+        out_image, out_transform, out_meta, out_colormap = clip_raster(raster, read_feature_layer(feature_layer_path, id_key), index)
+        clipped_band1 = out_image[0]
+
+      # write the image
+      with rasterio.open(output_raster_file, "w", **out_meta) as dest:
+        dest.write(clipped_band1, 1)
+        dest.write_colormap(1, out_colormap)
+
+      if lock and shared_counter:
+        with lock: shared_counter.value += 1
+
+  return len(features)
+
+def process_feature_layer(raster: DatasetReader, feature_layer_path: str, id_key: str, output_folder_path: str | None = None, *, feature_windows_path: str | None = None, status: Status | None = None, status_prefix: str = '', show_progress_bar: bool = False, shared_counter: Optional[ValueProxy[int]] = None, lock: Optional[SyncManager.Lock] = None) -> list[dict[str, Any]]:
   # open the vector feature layer
   if status: status.update(f'{status_prefix}Opening feature layer...')
   with alive_bar(title='Opening feature layer', disable=not show_progress_bar, monitor=False) as bar:
     feature_layer = read_feature_layer(feature_layer_path, id_key)
   if status: status.console.log(f'{status_prefix}feature layer loaded')
   
+  # compute the pixel class counts for every feature up front in a single
+  # vectorized pass over the raster instead of clipping and counting
+  # feature-by-feature
+  if status: status.update(f'{status_prefix}Computing zonal pixel counts...')
+  zonal_counts = _zonal_pixel_class_counts(raster, feature_layer)
+  if status: status.console.log(f'{status_prefix}Zonal pixel counts computed')
+
   # loop through each feature in the feature layer
   breakdowns: list[dict[str, Any]] = []
+  output_features: list[tuple[Any, dict[str, Any]]] = []
   with alive_bar(feature_layer.shape[0], title='Summarizing pixels within features', disable=not show_progress_bar) as bar:
-    for index, row in feature_layer.iterrows():
+    for position, (index, row) in enumerate(feature_layer.iterrows()):
       id = row[id_key]
-      loop_status_prefix = f'{status_prefix}[{id}] '
-      
-      # create output folder
-      _output_folder_path = output_folder_path or './temp' # if the output folder path is not provided, use a temporary folder
-      output_folder = f'{_output_folder_path}/{id}'
-      output_raster_file = f'{output_folder}/{raster_name}__{feature_layer_name}.tiff'
-      output_json_file = f'{output_folder}/{raster_name}__{feature_layer_name}.json'
-      if (not os.path.isdir(output_folder)):
-        if status: status.update(f'{loop_status_prefix}Creating folder {output_folder}...')
-        os.makedirs(output_folder, exist_ok=True)
-        if status: status.console.log(f'{loop_status_prefix}Folder {output_folder} created')
-      
-      # clip raster
-      out_image, out_transform, out_meta, out_colormap = clip_raster(raster, feature_layer, index, status=status, status_prefix=loop_status_prefix)
-      
-      # get the clipped band 1
-      clipped_band1 = out_image[0]
-      
-      # count the number of pixels for each class in the clipped band
-      if status: status.update(f'{loop_status_prefix}Parsing raster pixels...')
-      clipped_pixel_classes, clipped_pixel_counts = numpy.unique(clipped_band1, return_counts=True)
-      clipped_pixel_class_counts = dict(zip(clipped_pixel_classes.tolist(), clipped_pixel_counts.tolist()))
-      if status: status.console.log(f'{loop_status_prefix}Raster pixels parsed')
-      
+
+      # look up the pixel counts for this feature from the zonal pass
+      feature_counts = zonal_counts[position + 1]
+      clipped_pixel_class_counts = {int(pixel_class): int(feature_counts[pixel_class]) for pixel_class in numpy.flatnonzero(feature_counts)}
+
       # generate metadata for the feature
       feature_metadata = {
         # 'ID': row['ID'],
         # 'Area': row['Area'],
         'id': id,
-        'total_pixels': int(numpy.sum(clipped_pixel_counts)),
+        'total_pixels': int(feature_counts.sum()),
         'pixel_counts': clipped_pixel_class_counts
       }
-      
-      # save the feature metadata to json
-      if status: status.update(f'{loop_status_prefix}Saving metadata...')
       breakdowns.append(feature_metadata)
+
       if output_folder_path is not None:
-        with open(output_json_file, "w") as file:
-          json.dump(feature_metadata, file, indent=2) 
-          if status: status.console.log(f'{loop_status_prefix}Metadata saved to {output_json_file}')
-      
-      # write the image
-      if output_folder_path is not None:
-        with rasterio.open(output_raster_file, "w", **out_meta) as dest:
-          if status: status.update(f'{loop_status_prefix}Writing clipped raster...')
-          dest.write(out_image[0], 1)
-          dest.write_colormap(1, out_colormap)
-          if status: status.console.log(f'{loop_status_prefix}Clipped raster saved to {output_raster_file}')
-      
-      # clean up temp feature folder
-      if output_folder_path is None:
-        if status: status.update(f'{loop_status_prefix}Deleting temp folder {output_folder}...')
-        shutil.rmtree(output_folder)
-        if status: status.console.log(f'{loop_status_prefix}Temp folder {output_folder} deleted')
-        
-      bar()
-      if lock and shared_counter:
-        with lock: shared_counter.value += 1
-  
-  # clean up main temp folder
-  if output_folder_path is None:
-    if status: status.update(f'{status_prefix}Deleting temp folder {_output_folder_path}...')
-    shutil.rmtree(_output_folder_path)
-    if status: status.console.log(f'{status_prefix}Temp folder {_output_folder_path} deleted')
-    
+        output_features.append((index, feature_metadata))
+      else:
+        bar()
+        if lock and shared_counter:
+          with lock: shared_counter.value += 1
+
+    # save the feature metadata and clipped rasters with a pool of worker
+    # processes: every feature writes to its own files, so the remaining
+    # per-feature work (windowed read, mask fill, json + tiff writes)
+    # parallelizes cleanly now that the counts come from the zonal pass
+    if output_features:
+      if status: status.update(f'{status_prefix}Saving per-feature metadata and clipped rasters...')
+      # keep the pool small: this already runs inside the per-year worker
+      # processes started by generate_summary_data
+      workers = max(1, (cpu_count() - 1) // 4)
+      batch_size = max(math.ceil(len(output_features) / (workers * 4)), 1)
+      batches = [output_features[pos:pos + batch_size] for pos in range(0, len(output_features), batch_size)]
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_write_feature_outputs, batch, raster.name, feature_layer_path, id_key, output_folder_path, feature_windows_path, shared_counter, lock) for batch in batches]
+        for future in as_completed(futures):
+          bar(future.result())
+      if status: status.console.log(f'{status_prefix}Per-feature metadata and clipped rasters saved to {output_folder_path}')
+
   return breakdowns